@@ -57,29 +57,86 @@ This starts a HTTPServer and creates a html file which is dynamically updated
 each time ``lviz`` is called. See https://i.imgur.com/jjwvAX2.png for the
 output of the above commands.
 """
-import base64
 try:
-    import BaseHTTPServer
-    import SimpleHTTPServer
-except ModuleNotFoundError: # noqa (Python 3 only)
-    import http.server as SimpleHTTPServer
-    import http.server as BaseHTTPServer
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+import atexit
+import collections
 import contextlib
+from concurrent import futures
 import functools
+import hashlib
+import html
+import http.server
 import io
+import itertools
 import logging
 import os
+import re
 import socket
+import sys
 import tempfile
 import threading
+from urllib import parse
+import uuid
+import weakref
 
-import matplotlib.pyplot as plt
+import matplotlib
+import matplotlib.rcsetup
+import numpy as np
+
+
+def _backend_is_configured():
+    """Whether pyplot is in use or the user picked a matplotlib backend.
+
+    :rtype: bool
+    """
+    if 'matplotlib.pyplot' in sys.modules:
+        return True
+    # ``MPLBACKEND`` and matplotlibrc both end up in rcParams, which holds a
+    # sentinel until a backend is chosen.
+    backend = dict.__getitem__(matplotlib.rcParams, 'backend')
+    sentinel = getattr(matplotlib.rcsetup, '_auto_backend_sentinel', None)
+    return backend is not sentinel
+
+
+# The plots are only ever rendered to png, GUI backends are pure overhead.
+# The caller's choice of backend is respected though.
+if not _backend_is_configured():
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa (must follow matplotlib.use)
+
+try:
+    import pandas as pd
+except ImportError:
+    # Only needed when dataframes are written, which implies pandas.
+    pd = None
 
 
 log = logging.getLogger(__name__)
+#: Looked up once, it is only used in log messages.
+_HOSTNAME = socket.gethostname()
 
 #: The different HTML header levels.
 HEADER_LEVELS = range(1, 6)
+#: The resolution of the rendered figures unless a ``dpi`` is passed in.
+DEFAULT_FIGURE_DPI = 72
+#: The zlib compression level (0-9) of the rendered pngs. The html is served
+#: locally, so fast encoding beats a smaller file.
+DEFAULT_PNG_COMPRESS_LEVEL = 1
+#: The maximum number of rows of a pandas dataframe rendered to html.
+DEFAULT_MAX_ROWS = 200
+#: The number of rendered pandas dataframes kept around for reuse.
+DF_CACHE_SIZE = 32
+#: Appended to the html file name (sans extension) to name its figure dir.
+FIGURE_DIR_SUFFIX = '_figs'
+#: The methods of :class:`HtmlGenerator` exposed by :class:`LocalViz`.
+_FORWARDED = ('header', 'p', 'br', 'hr', 'figure', 'write', 'flush')
+#: The header shorthand methods (``h1``, ``h2``, ...) mapped to their level.
+_HEADER_METHODS = {'h{lvl}'.format(lvl=lvl): lvl for lvl in HEADER_LEVELS}
+#: The :class:`HtmlGenerator` instances whose file is still open.
+_OPEN_GENERATORS = weakref.WeakSet()
 HTML_BEGIN_BOILERPLATE = """
 <!DOCTYPE html>
 <html>
@@ -129,6 +186,20 @@ HTML_END_BOILERPLATE = """
     </body>
     </html>
 """
+_HTML_BEGIN_BYTES = HTML_BEGIN_BOILERPLATE.encode('utf-8')
+_HTML_END_BYTES = HTML_END_BOILERPLATE.encode('utf-8')
+
+# Pre-encoded fixed html fragments (with the trailing newline ``write`` adds).
+_BR = b'<br/>\n'
+_HR = b'<br/><hr/><br/>\n'
+_IMG_PREFIX = b'<img src="data:image/png;base64,'
+_IMG_SUFFIX = b'" width="500"><br/>\n'
+# The printf style formats of the numpy dtype kinds rendered with numpy.
+_NUMERIC_FORMATS = {'i': '%d', 'u': '%d', 'f': '%.6g'}
+# The names of the figures saved by :class:`HtmlGenerator`.
+_FIGURE_NAME_RE = re.compile(r'^[0-9a-f]{8}_[0-9]{6,}\.png$')
+# Escapes the characters which would otherwise be parsed as html markup.
+_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
 
 
 def validate_lviz_started(method):
@@ -164,13 +235,36 @@ class LocalViz(object):
     :vartype run_server: bool
     :ivar port: The port at which the server is to be started.
     :vartype port: int
+    :ivar png_compress_level: The zlib compression level of the figures.
+    :vartype png_compress_level: int
+    :ivar max_rows: The maximum number of rows of a dataframe to render.
+    :vartype max_rows: int
+    :ivar escape: Whether the text of headers and paragraphs is html escaped.
+    :vartype escape: bool
+    :ivar inline_figures: Whether the figures are embedded in the html as
+        base64 data urls instead of being saved to :func:`figure_dir`.
+    :vartype inline_figures: bool
     :ivar _html_gen: A container for the html generation.
     :vartype _html_gen: HtmlGenerator
+    :ivar _server: The background http server, if running.
+    :vartype _server: LocalHTTPServer or NoneType
+    :ivar _thread: The daemon thread running ``_server``.
+    :vartype _thread: threading.Thread or NoneType
     :ivar is_started: Has the start been called.
     :vartype is_started: bool
     """
 
-    def __init__(self, lazy=False, html_file=None, run_server=True, port=9111):
+    def __init__(
+        self,
+        lazy=False,
+        html_file=None,
+        run_server=True,
+        port=9111,
+        png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+        max_rows=DEFAULT_MAX_ROWS,
+        escape=False,
+        inline_figures=False,
+    ):
         """Constructor.
 
         :param lazy: Whether the server should started and the html file
@@ -180,7 +274,13 @@ class LocalViz(object):
         self.html_file = html_file
         self.port = port
         self.run_server = run_server
+        self.png_compress_level = png_compress_level
+        self.max_rows = max_rows
+        self.escape = escape
+        self.inline_figures = inline_figures
         self._html_gen = None
+        self._server = None
+        self._thread = None
         self.is_started = False
         if not lazy:
             self.start()
@@ -192,10 +292,12 @@ class LocalViz(object):
 
             * ``self.html_file``
             * ``self._html_gen``
+            * ``self._server``
+            * ``self._thread``
             * ``self.is_started``
         """
         if self.run_server:
-            run_bgd_server(
+            self._server, self._thread = run_bgd_server(
                 port=self.port,
                 host='localhost',
             )
@@ -207,45 +309,72 @@ class LocalViz(object):
                 dir=os.getcwd(),
                 suffix='.html',
             )
-        self._html_gen = HtmlGenerator(output_fl=self.html_file)
-        # Copy over the public functions pf :class:`HtmlGenerator`.
-        for name in dir(self._html_gen):
-            if name.startswith('_'):
-                continue
-            member = getattr(self._html_gen, name)
-            if callable(member):
-                setattr(self, name, member)
+        self._html_gen = HtmlGenerator(
+            output_fl=self.html_file,
+            png_compress_level=self.png_compress_level,
+            max_rows=self.max_rows,
+            escape=self.escape,
+            inline_figures=self.inline_figures,
+        )
+        # Copy over the public functions of :class:`HtmlGenerator`.
+        for name in _FORWARDED:
+            setattr(self, name, getattr(self._html_gen, name))
+        fl = self.html_file.split('/')[-1]
         log.info(
-            'Click: http://{hn}:{p}/{fl} or http://{h}:{p}/{fl}'.format(
-                hn=socket.gethostname(),
-                h='localhost',
-                p=self.port,
-                fl=self.html_file.split('/')[-1],
-            ),
+            'Click: http://%s:%d/%s or http://%s:%d/%s',
+            _HOSTNAME, self.port, fl, 'localhost', self.port, fl,
         )
         self.is_started = True
 
+    def __getattr__(self, name):
+        """Exposes the ``h1``, ``h2``, ... methods of :class:`HtmlGenerator`.
+        """
+        html_gen = self.__dict__.get('_html_gen')
+        if html_gen is None or name not in _HEADER_METHODS:
+            raise AttributeError(name)
+        return getattr(html_gen, name)
+
     @validate_lviz_started
     def inform_cleanup(self):
         """Informs the user which html file to delete at the end."""
         if self.html_file:
             log.info(
-                'After viewing the plots, please delete the '
-                'file: `{fl}`'.format(fl=self.html_file),
+                'After viewing the plots, please delete the file: `%s`',
+                self.html_file,
             )
 
     @validate_lviz_started
     def close(self):
-        """Writes the closing html tags to the html file."""
-        self._html_gen.write(HTML_END_BOILERPLATE)
+        """Writes the closing html tags, closes the file and stops the server.
+
+        The html is no longer served afterwards, see :meth:`shutdown`.
+        """
+        self._html_gen.close_file()
+        self.shutdown()
+
+    def shutdown(self):
+        """Stops the background http server and releases its socket.
+
+        The html file is left untouched and can still be written to.
+
+        .. note:: Mutates ``self._server`` and ``self._thread``.
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join(timeout=1)
+        self._server = None
+        self._thread = None
 
     @validate_lviz_started
     def del_html(self):
-        """Deletes the generated html file.
+        """Deletes the generated html file and its figures.
 
         .. note:: Mutates ``self.html_file``.
         """
         delete_files_silently([self.html_file])
+        delete_figures(figure_dir(self.html_file))
         self.html_file = None
 
 
@@ -255,17 +384,77 @@ class HtmlGenerator(object):
 
     The class also exposes the methods ``h1``, ``h2``, ..., ``h6`` for writing
     headers.
+
+    Every write is appended to the output file right away, so the html is
+    updated as the script runs. Figures are saved as pngs in
+    :func:`figure_dir` (or base64 encoded if ``inline_figures``) on a
+    single writer thread; html written meanwhile is queued behind them on
+    the same thread to keep the order. :meth:`flush` blocks until all the
+    writes have landed in the file.
+
+    :ivar png_compress_level: The zlib compression level (0-9) of the pngs.
+    :vartype png_compress_level: int
+    :ivar max_rows: The maximum number of rows of a dataframe to render.
+    :vartype max_rows: int
+    :ivar escape: Whether the text of headers and paragraphs is html escaped.
+    :vartype escape: bool
+    :ivar inline_figures: Whether the figures are embedded in the html as
+        base64 data urls instead of being saved to :func:`figure_dir`.
+    :vartype inline_figures: bool
+    :ivar _fd: The descriptor of the output file opened with ``O_APPEND``,
+        so that every write lands atomically at the end of the file.
+        ``None`` once closed.
+    :vartype _fd: int or NoneType
+    :ivar _pool: The single writer thread, which keeps the writes ordered.
+    :vartype _pool: concurrent.futures.ThreadPoolExecutor
+    :ivar _pending: The futures of the writes in submission order.
+    :vartype _pending: collections.deque
+    :ivar _fig_dir: The directory the figures are saved to.
+    :vartype _fig_dir: str
+    :ivar _fig_ctr: Numbers the figures saved to ``_fig_dir``.
+    :vartype _fig_ctr: itertools.count
+    :ivar _fig_prefix: Unique to this generator, so that the browser never
+        shows a cached figure of a previous run.
+    :vartype _fig_prefix: str
+    :ivar _df_cache: LRU cache of the rendered html of the last
+        :data:`DF_CACHE_SIZE` dataframes keyed by :func:`df_cache_key`.
+    :vartype _df_cache: collections.OrderedDict
     """
 
-    def __init__(self, output_fl=None):
+    def __init__(
+        self,
+        output_fl=None,
+        png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+        max_rows=DEFAULT_MAX_ROWS,
+        escape=False,
+        inline_figures=False,
+    ):
         self.output_fl = output_fl
-        self.write(HTML_BEGIN_BOILERPLATE)
-        for lvl in HEADER_LEVELS:
-            setattr(
-                self,
-                'h{lvl}'.format(lvl=lvl),
-                functools.partial(self.header, level=lvl),
-            )
+        self.png_compress_level = png_compress_level
+        self.max_rows = max_rows
+        self.escape = escape
+        self.inline_figures = inline_figures
+        self._df_cache = collections.OrderedDict()
+        self._fd = os.open(
+            output_fl,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644,
+        )
+        write_fully(self._fd, _HTML_BEGIN_BYTES)
+        self._pool = futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = collections.deque()
+        self._fig_dir = figure_dir(output_fl)
+        self._fig_ctr = itertools.count()
+        self._fig_prefix = uuid.uuid4().hex[:8]
+        _OPEN_GENERATORS.add(self)
+
+    def __getattr__(self, name):
+        """Creates the ``h1``, ``h2``, ... methods on first access."""
+        if name not in _HEADER_METHODS:
+            raise AttributeError(name)
+        method = functools.partial(self.header, level=_HEADER_METHODS[name])
+        self.__dict__[name] = method
+        return method
 
     def header(self, text, level=4):
         """Creates a header line of given level.
@@ -275,7 +464,9 @@ class HtmlGenerator(object):
         :param level: The level of the html header.
         :type level: int
         """
-        self.write('<h{lvl}>{text}</h{lvl}>'.format(text=text, lvl=level))
+        if self.escape:
+            text = str(text).translate(_ESCAPE_TABLE)
+        self.write(f'<h{level}>{text}</h{level}>')
 
     def p(self, text):
         """Writes a paragraph tagged text.
@@ -283,16 +474,18 @@ class HtmlGenerator(object):
         :param text: The html paragraph text.
         :type text: str
         """
-        self.write('<p>{t}</p>'.format(t=text))
+        if self.escape:
+            text = str(text).translate(_ESCAPE_TABLE)
+        self.write(f'<p>{text}</p>')
 
     def br(self):
         """Inserts a break line in the html file."""
-        self.write('<br/>')
+        self._emit(_BR)
 
     def hr(self):
         """Inserts a horizontal line wrapped in blank lines in the html file.
         """
-        self.write('<br/><hr/><br/>')
+        self._emit(_HR)
 
     @contextlib.contextmanager
     def figure(self, **figure_kwargs):
@@ -306,16 +499,27 @@ class HtmlGenerator(object):
         """
         fig = plt.figure(**figure_kwargs)
         fig_fl = io.BytesIO()
-        yield fig
-        plt.savefig(fig_fl, format='png')
-        fig_fl.seek(0)
-        fig_png = base64.b64encode(fig_fl.getvalue())
-        fig_png = fig_png.decode('ascii')
-        self.write(
-            '<img src="data:image/png;base64,{fig_png}" '
-            'width="500"><br/>'.format(fig_png=fig_png),
-        )
-        fig_fl.close()
+        try:
+            yield fig
+            plt.savefig(
+                fig_fl,
+                format='png',
+                dpi=figure_kwargs.get('dpi', DEFAULT_FIGURE_DPI),
+                pil_kwargs={'compress_level': self.png_compress_level},
+            )
+        finally:
+            # Otherwise pyplot keeps a reference to every figure ever drawn.
+            plt.close(fig)
+        # The png has to be rendered here as matplotlib is not thread safe,
+        # but encoding and writing it can overlap with the caller's work.
+        if self.inline_figures:
+            self._submit(self._encode_and_write, fig_fl)
+        else:
+            fig_name = '{p}_{n:06d}.png'.format(
+                p=self._fig_prefix,
+                n=next(self._fig_ctr),
+            )
+            self._submit(self._save_and_link, fig_fl, fig_name)
 
     def write(self, text_or_df):
         """Appends the text or a pandas df to the output file.
@@ -328,9 +532,323 @@ class HtmlGenerator(object):
             text = text_or_df
         else:
             # Assume it is a pandas dataframe
-            text = text_or_df.to_html()
-        with open(self.output_fl, 'a+') as outfile:
-            outfile.write('{s}\n'.format(s=text))
+            text = self._render_df(text_or_df)
+        self._emit(_to_bytes(text), b'\n')
+
+    def _render_df(self, df):
+        """Renders the dataframe as a html table, reusing earlier renders.
+
+        :param df: The dataframe to render.
+        :type df: pandas.DataFrame
+
+        :rtype: str
+        """
+        if len(df) > self.max_rows:
+            # Only ``max_rows`` rows are rendered, hashing every row to look
+            # up the cache would cost far more than rendering.
+            return df_to_html(df, max_rows=self.max_rows)
+        try:
+            key = df_cache_key(df)
+        except TypeError:
+            # Unhashable cell values, can't be cached.
+            return df_to_html(df, max_rows=self.max_rows)
+        rendered = self._df_cache.pop(key, None)
+        if rendered is None:
+            rendered = df_to_html(df, max_rows=self.max_rows)
+        self._df_cache[key] = rendered
+        if len(self._df_cache) > DF_CACHE_SIZE:
+            self._df_cache.popitem(last=False)
+        return rendered
+
+    def _emit(self, *chunks):
+        """Appends already encoded html to the output file.
+
+        The html is written right away unless figures are still being
+        written, in which case it is queued behind them on the writer
+        thread to keep the order.
+
+        :param chunks: The utf-8 encoded html.
+        :type chunks: bytes
+
+        :raises ValueError: If the output file is closed.
+        """
+        self._check_open()
+        self._reap()
+        if self._pending:
+            self._submit(self._write_chunks, chunks)
+        else:
+            self._write_chunks(chunks)
+
+    def _submit(self, fn, *args):
+        """Queues up ``fn`` on the writer thread.
+
+        :raises ValueError: If the output file is closed.
+        """
+        self._check_open()
+        self._pending.append(self._pool.submit(fn, *args))
+        self._reap()
+
+    def _check_open(self):
+        """Raises a :class:`ValueError` if the output file is closed."""
+        if self._fd is None:
+            raise ValueError(
+                'html file is closed: {fl}'.format(fl=self.output_fl),
+            )
+
+    def _reap(self):
+        """Drops the futures which are done.
+
+        Errors raised on the writer thread thus surface in the caller.
+        """
+        while self._pending and self._pending[0].done():
+            self._pending.popleft().result()
+
+    def _write_chunks(self, chunks):
+        """Appends the chunks to the output file.
+
+        :param chunks: The utf-8 encoded html.
+        :type chunks: tuple of bytes
+        """
+        write_fully(self._fd, b''.join(chunks))
+
+    def _encode_and_write(self, fig_fl):
+        """Writes the png as an inline image. Runs on the writer thread.
+
+        :param fig_fl: The rendered png, closed once written.
+        :type fig_fl: io.BytesIO
+        """
+        # Encode straight from the BytesIO buffer to avoid copying the png.
+        fig_view = fig_fl.getbuffer()
+        try:
+            fig_png = _b64.b64encode(fig_view)
+        finally:
+            fig_view.release()
+            fig_fl.close()
+        self._write_chunks((_IMG_PREFIX, fig_png, _IMG_SUFFIX))
+
+    def _save_and_link(self, fig_fl, fig_name):
+        """Saves the png and links it in the html. Runs on the writer thread.
+
+        :param fig_fl: The rendered png, closed once written.
+        :type fig_fl: io.BytesIO
+        :param fig_name: The file name of the png within ``_fig_dir``.
+        :type fig_name: str
+        """
+        os.makedirs(self._fig_dir, exist_ok=True)
+        fig_view = fig_fl.getbuffer()
+        try:
+            with open(os.path.join(self._fig_dir, fig_name), 'wb') as fig_out:
+                fig_out.write(fig_view)
+        finally:
+            fig_view.release()
+            fig_fl.close()
+        src = parse.quote(
+            '{d}/{f}'.format(d=os.path.basename(self._fig_dir), f=fig_name),
+        )
+        self._write_chunks((
+            f'<img src="{src}" width="500"><br/>\n'.encode('utf-8'),
+        ))
+
+    def flush(self):
+        """Blocks until all the pending writes (including figures) are done.
+        """
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close_file(self):
+        """Writes the closing html tags and closes the output file."""
+        if self._fd is not None:
+            self._emit(_HTML_END_BYTES)
+            self.flush()
+            self._pool.shutdown()
+            os.close(self._fd)
+            self._fd = None
+            _OPEN_GENERATORS.discard(self)
+
+    def __del__(self):
+        # Queued writes hold a reference to ``self``, so by now every write
+        # has landed in the file and only the descriptor is left to close.
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+
+
+class LocalHTTPServer(http.server.ThreadingHTTPServer):
+
+    """Serves every request in its own thread.
+
+    A large html file being downloaded doesn't block the other requests and
+    the port can be rebound right after a previous server is gone.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SendfileHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    """Sends the files with ``sendfile(2)`` instead of copying them in python.
+    """
+
+    def copyfile(self, source, outputfile):
+        """Copies the file straight from the page cache into the socket.
+
+        Falls back to the chunked copy in python when ``sendfile`` is not
+        supported for the file or the platform.
+        """
+        if outputfile is not self.wfile:
+            return super().copyfile(source, outputfile)
+        try:
+            offset = source.tell()
+            count = os.fstat(source.fileno()).st_size - offset
+            self.connection.sendfile(source, offset=offset, count=count)
+        except (AttributeError, io.UnsupportedOperation):
+            super().copyfile(source, outputfile)
+
+
+def figure_dir(html_file):
+    """The directory next to the html file where its figures are saved.
+
+    :param html_file: Path to the html file.
+    :type html_file: str
+
+    :rtype: str
+    """
+    return os.path.splitext(html_file)[0] + FIGURE_DIR_SUFFIX
+
+
+def df_to_html(df, max_rows):
+    """Renders the dataframe as a compact html table.
+
+    The default ``RangeIndex`` is dropped and the borders come from the
+    stylesheet in :data:`HTML_BEGIN_BOILERPLATE`. Untruncated int and float
+    frames are rendered by :func:`numeric_df_to_html`.
+
+    :param df: The dataframe to render.
+    :type df: pandas.DataFrame
+    :param max_rows: The maximum number of rows to render.
+    :type max_rows: int
+
+    :rtype: str
+    """
+    has_default_index = (
+        isinstance(df.index, pd.RangeIndex) and
+        df.index.start == 0 and
+        df.index.step == 1
+    )
+    is_plain_numeric = (
+        df.shape[1] > 0 and
+        all(
+            isinstance(dtype, np.dtype) and dtype.kind in _NUMERIC_FORMATS
+            for dtype in df.dtypes
+        )
+    )
+    if (
+        has_default_index and
+        is_plain_numeric and
+        df.columns.nlevels == 1 and
+        len(df) <= max_rows
+    ):
+        return numeric_df_to_html(df)
+    return df.to_html(
+        max_rows=max_rows,
+        border=0,
+        index=not has_default_index,
+    )
+
+
+def numeric_df_to_html(df):
+    """Renders an int/float dataframe with vectorized numpy formatting.
+
+    The table has the structure of ``df.to_html(index=False, border=0)``,
+    but the cells are formatted a column at a time with ``%d`` for ints and
+    ``%.6g`` for floats (missing values as ``NaN``), ignoring the pandas
+    display options. So ``1.0`` renders as ``1`` and ``10000000.0`` as
+    ``1e+07``.
+
+    :param df: The dataframe, whose columns all have a numpy int or float
+        dtype.
+    :type df: pandas.DataFrame
+
+    :rtype: str
+    """
+    cells = np.empty(df.shape, dtype=object)
+    for i, dtype in enumerate(df.dtypes):
+        values = df.iloc[:, i].to_numpy()
+        col = np.char.mod(_NUMERIC_FORMATS[dtype.kind], values)
+        if dtype.kind == 'f':
+            col[np.isnan(values)] = 'NaN'
+        cells[:, i] = col
+    header = ''.join(
+        '<th>{c}</th>'.format(c=html.escape(str(col))) for col in df.columns
+    )
+    body = '\n'.join(
+        '    <tr><td>' + '</td><td>'.join(row) + '</td></tr>'
+        for row in cells.tolist()
+    )
+    return (
+        '<table class="dataframe">\n'
+        '  <thead>\n'
+        '    <tr style="text-align: right;">' + header + '</tr>\n'
+        '  </thead>\n'
+        '  <tbody>\n' + body + '\n'
+        '  </tbody>\n'
+        '</table>'
+    )
+
+
+def df_cache_key(df):
+    """Computes a key identifying the contents of a pandas dataframe.
+
+    :param df: The dataframe.
+    :type df: pandas.DataFrame
+
+    :raises TypeError: If the dataframe contains unhashable values.
+    :rtype: tuple
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=True).values
+    return (
+        df.shape,
+        tuple(df.columns),
+        tuple(df.index.names),
+        tuple(str(dtype) for dtype in df.dtypes),
+        hashlib.sha1(row_hashes.tobytes()).hexdigest(),
+    )
+
+
+@atexit.register
+def _flush_open_generators():
+    """Waits for the pending writes of the generators which were not closed.
+    """
+    for html_gen in list(_OPEN_GENERATORS):
+        html_gen.flush()
+
+
+def write_fully(fd, data):
+    """Writes all the data to the file descriptor.
+
+    ``os.write`` is a single syscall which may write only part of the data.
+
+    :param fd: The file descriptor.
+    :type fd: int
+    :param data: The data to write.
+    :type data: bytes
+    """
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _to_bytes(text):
+    """Encodes the text as utf-8 unless it already is a byte string.
+
+    :param text: The text to be encoded.
+    :type text: str or bytes
+
+    :rtype: bytes
+    """
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
 
 
 def run_bgd_server(port, host='localhost'):
@@ -342,21 +860,44 @@ def run_bgd_server(port, host='localhost'):
     :param port: The port where the local server should serve.
     :type port: int
 
-    :returns: A daemon thread running a simple http server in the background.
-    :type: threading.Thread
+    :returns: The server and the daemon thread running it in the background.
+    :rtype: tuple(LocalHTTPServer, threading.Thread)
     """
-    logging.info(
-        'Starting background server at: '
-        'http://{h}:{p}/.'.format(h=host, p=port),
-    )
-    server = BaseHTTPServer.HTTPServer(
+    logging.info('Starting background server at: http://%s:%d/.', host, port)
+    server = LocalHTTPServer(
         server_address=(host, port),
-        RequestHandlerClass=SimpleHTTPServer.SimpleHTTPRequestHandler,
+        RequestHandlerClass=SendfileHTTPRequestHandler,
     )
+    # serve_forever already waits on a selector (releasing the GIL) between
+    # requests, and each request is handled on its own thread.
     thread = threading.Thread(target=server.serve_forever)
     thread.daemon = True
     thread.start()
-    return thread
+    return server, thread
+
+
+def delete_figures(fig_dir):
+    """Deletes the figures saved by :class:`HtmlGenerator` in ``fig_dir``.
+
+    Any other file is left alone and the directory is only removed if it
+    ends up empty.
+
+    :param fig_dir: The figure directory, see :func:`figure_dir`.
+    :type fig_dir: str
+    """
+    try:
+        names = os.listdir(fig_dir)
+    except OSError:
+        return
+    delete_files_silently([
+        os.path.join(fig_dir, name)
+        for name in names
+        if _FIGURE_NAME_RE.match(name)
+    ])
+    try:
+        os.rmdir(fig_dir)
+    except OSError:
+        pass
 
 
 def delete_files_silently(files):
@@ -11,7 +11,12 @@ with open('README.md') as readme_file:
 with open('docs/source/HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['matplotlib']
+requirements = ['matplotlib>=3.3.0']
+
+extras_requirements = {
+    # SIMD accelerated base64 encoding of the figures.
+    'fast': ['pybase64'],
+}
 
 setup_requirements = [
     'pytest-runner',
@@ -31,7 +36,9 @@ setup(
     url='https://github.com/psvishnu91/local_visualizer',
     packages=find_packages(include=['local_visualizer']),
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     zip_safe=False,
     keywords='local_visualizer',
@@ -40,7 +47,9 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
     ],
     test_suite='tests',
     tests_require=test_requirements,
@@ -1,7 +1,18 @@
 #!/usr/bin/env python
 
+import os
+import re
+import socket
+import subprocess
+import sys
+from urllib import request
+
 import pytest
 
+from local_visualizer import local_visualizer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 
 @pytest.fixture
 def fake_input():
@@ -10,3 +21,294 @@ def fake_input():
 
 def test_stub():
     pass
+
+
+@pytest.fixture
+def html_file(tmpdir):
+    return str(tmpdir.join('lviz_test.html'))
+
+
+@pytest.fixture
+def lviz(html_file):
+    lviz = local_visualizer.LocalViz(html_file=html_file, run_server=False)
+    yield lviz
+    lviz.close()
+
+
+def read_html(lviz):
+    lviz.flush()
+    with open(lviz.html_file) as html:
+        return html.read()
+
+
+def test_text_is_written_before_close(lviz):
+    lviz.h3('A header')
+    lviz.p('A paragraph')
+    html = read_html(lviz)
+    assert '<h3>A header</h3>\n<p>A paragraph</p>\n' in html
+    assert '</html>' not in html
+
+
+def test_text_is_written_if_never_closed(html_file):
+    script = (
+        'from local_visualizer import LocalViz\n'
+        'lviz = LocalViz(html_file={fl!r}, run_server=False)\n'
+        'lviz.p("Never closed")\n'
+    ).format(fl=html_file)
+    subprocess.check_call(
+        [sys.executable, '-c', script],
+        cwd=ROOT_DIR,
+    )
+    with open(html_file) as html:
+        assert '<p>Never closed</p>' in html.read()
+
+
+def backend_after_import(script, mpl_backend=None):
+    """The matplotlib backend once ``script`` has imported local_visualizer.
+    """
+    env = dict(os.environ)
+    env.pop('MPLBACKEND', None)
+    if mpl_backend:
+        env['MPLBACKEND'] = mpl_backend
+    return subprocess.check_output(
+        [sys.executable, '-c', script + '\nprint(plt.get_backend())'],
+        cwd=ROOT_DIR,
+        env=env,
+    ).decode('utf-8').strip().lower()
+
+
+def test_agg_backend_is_the_default():
+    script = (
+        'import local_visualizer\n'
+        'import matplotlib.pyplot as plt'
+    )
+    assert backend_after_import(script) == 'agg'
+
+
+def test_configured_backend_is_kept():
+    script = (
+        'import matplotlib.pyplot as plt\n'
+        'import local_visualizer'
+    )
+    assert backend_after_import(script, mpl_backend='svg') == 'svg'
+    script = (
+        'import local_visualizer\n'
+        'import matplotlib.pyplot as plt'
+    )
+    assert backend_after_import(script, mpl_backend='svg') == 'svg'
+
+
+def test_mutated_dataframe_is_rendered_again(lviz):
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']})
+    lviz.write(df)
+    df.loc[1, 'b'] = 'mutated'
+    lviz.write(df)
+    html = read_html(lviz)
+    assert html.count('<td>y</td>') == 1
+    assert html.count('<td>mutated</td>') == 1
+    assert len(lviz._html_gen._df_cache) == 2
+
+
+def test_unhashable_dataframe_is_not_cached(lviz):
+    pd = pytest.importorskip('pandas')
+    lviz.write(pd.DataFrame({'a': [[1, 2], [3]]}))
+    assert '<td>[1, 2]</td>' in read_html(lviz)
+    assert not lviz._html_gen._df_cache
+
+
+def test_close_is_idempotent(lviz):
+    lviz.p('Closed twice')
+    lviz.close()
+    lviz.close()
+    with open(lviz.html_file) as html:
+        assert html.read().count('</html>') == 1
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_server_shutdown_frees_the_port(html_file, tmpdir):
+    port = get_free_port()
+    with tmpdir.as_cwd():
+        for _ in range(2):
+            lviz = local_visualizer.LocalViz(html_file=html_file, port=port)
+            lviz.p('Served')
+            lviz.flush()
+            url = 'http://localhost:{p}/lviz_test.html'.format(p=port)
+            assert b'<p>Served</p>' in request.urlopen(url).read()
+            lviz.close()
+            assert not lviz._thread
+            with pytest.raises(OSError):
+                request.urlopen(url, timeout=1)
+
+
+def test_escape(html_file):
+    lviz = local_visualizer.LocalViz(
+        html_file=html_file,
+        run_server=False,
+        escape=True,
+    )
+    lviz.h2('a < b & c')
+    lviz.p('<script>')
+    html = read_html(lviz)
+    lviz.close()
+    assert '<h2>a &lt; b &amp; c</h2>' in html
+    assert '<p>&lt;script&gt;</p>' in html
+
+
+def test_no_escape_by_default(lviz):
+    lviz.p('<b>bold</b>')
+    assert '<p><b>bold</b></p>' in read_html(lviz)
+
+
+@pytest.mark.parametrize('inline_figures', [True, False])
+def test_text_and_figures_stay_in_order(html_file, inline_figures):
+    lviz = local_visualizer.LocalViz(
+        html_file=html_file,
+        run_server=False,
+        inline_figures=inline_figures,
+    )
+    lviz.p('before')
+    with lviz.figure(figsize=(1, 1)):
+        local_visualizer.plt.plot([1, 2])
+    lviz.p('after')
+    lviz.close()
+    with open(html_file) as html_fl:
+        html = html_fl.read()
+    assert html.index('<p>before</p>') < html.index('<img')
+    assert html.index('<img') < html.index('<p>after</p>')
+    assert html.index('<p>after</p>') < html.index('</html>')
+
+
+def test_dataframe_labels_are_escaped(lviz):
+    pd = pytest.importorskip('pandas')
+    lviz.write(pd.DataFrame({'a<b': [1.5]}, index=['<x>']))
+    html = read_html(lviz)
+    assert '<th>a&lt;b</th>' in html
+    assert '<th>&lt;x&gt;</th>' in html
+
+
+def linked_figures(html_file):
+    with open(html_file) as html:
+        srcs = re.findall(r'<img src="([^"]+)"', html.read())
+    return [
+        os.path.join(os.path.dirname(html_file), src) for src in srcs
+    ]
+
+
+def test_figure_is_saved_and_linked(html_file):
+    fig_names = set()
+    for _ in range(2):
+        lviz = local_visualizer.LocalViz(html_file=html_file, run_server=False)
+        with lviz.figure(figsize=(1, 1)):
+            local_visualizer.plt.plot([1, 2])
+        lviz.close()
+        fig_fl, = linked_figures(html_file)
+        with open(fig_fl, 'rb') as png:
+            assert png.read(8) == b'\x89PNG\r\n\x1a\n'
+        fig_names.add(os.path.basename(fig_fl))
+    # Each run names its figures differently so that the browser doesn't
+    # show a cached figure of a previous run.
+    assert len(fig_names) == 2
+    lviz.del_html()
+    assert not os.path.exists(os.path.dirname(fig_fl))
+
+
+def test_only_own_figures_are_deleted(html_file):
+    fig_dir = local_visualizer.figure_dir(html_file)
+    os.makedirs(fig_dir)
+    users_fl = os.path.join(fig_dir, 'mine.png')
+    open(users_fl, 'w').close()
+    lviz = local_visualizer.LocalViz(html_file=html_file, run_server=False)
+    with lviz.figure(figsize=(1, 1)):
+        local_visualizer.plt.plot([1, 2])
+    lviz.close()
+    assert len(os.listdir(fig_dir)) == 2
+    lviz.del_html()
+    assert os.listdir(fig_dir) == ['mine.png']
+
+
+def test_numeric_dataframe_fast_path():
+    pd = pytest.importorskip('pandas')
+    np = pytest.importorskip('numpy')
+    df = pd.DataFrame({
+        'a<': np.array([1, 2], dtype='int64'),
+        'b': np.array([1.5, np.nan]),
+        'c': np.array([10000000.0, 1.0]),
+    })
+    html = local_visualizer.df_to_html(df, max_rows=200)
+    assert '<th>a&lt;</th><th>b</th><th>c</th>' in html
+    assert '<tr><td>1</td><td>1.5</td><td>1e+07</td></tr>' in html
+    assert '<tr><td>2</td><td>NaN</td><td>1</td></tr>' in html
+    assert '<th>0</th>' not in html
+
+
+@pytest.mark.parametrize('df_kwargs', [
+    # Nullable extension dtype.
+    {'data': {'a': [1, None]}, 'dtype': 'Int64'},
+    # Non default index.
+    {'data': {'a': [1.0, 2.0]}, 'index': ['x', 'y']},
+    # Mixed dtypes.
+    {'data': {'a': [1.0, 2.0], 'b': ['x', 'y']}},
+])
+def test_dataframes_outside_the_fast_path(df_kwargs):
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame(**df_kwargs)
+    html = local_visualizer.df_to_html(df, max_rows=200)
+    expected = df.to_html(
+        max_rows=200,
+        border=0,
+        index=not isinstance(df.index, pd.RangeIndex),
+    )
+    assert html == expected
+
+
+def test_long_numeric_dataframe_is_truncated():
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame({'a': range(10)})
+    html = local_visualizer.df_to_html(df, max_rows=4)
+    assert html == df.to_html(max_rows=4, border=0, index=False)
+
+
+def test_long_dataframe_skips_the_cache(html_file):
+    pd = pytest.importorskip('pandas')
+    lviz = local_visualizer.LocalViz(
+        html_file=html_file,
+        run_server=False,
+        max_rows=4,
+    )
+    lviz.write(pd.DataFrame({'a': range(10)}))
+    lviz.write(pd.DataFrame({'a': range(4)}))
+    html = read_html(lviz)
+    lviz.close()
+    assert html.count('<table') == 2
+    assert len(lviz._html_gen._df_cache) == 1
+
+
+def test_escape_non_str(html_file):
+    lviz = local_visualizer.LocalViz(
+        html_file=html_file,
+        run_server=False,
+        escape=True,
+    )
+    lviz.h2(3.5)
+    lviz.p(42)
+    html = read_html(lviz)
+    lviz.close()
+    assert '<h2>3.5</h2>\n<p>42</p>\n' in html
+
+
+def test_write_after_close_raises(lviz):
+    lviz.close()
+    with pytest.raises(ValueError, match='html file is closed'):
+        lviz.p('Too late')
+    with pytest.raises(ValueError, match='html file is closed'):
+        with lviz.figure(figsize=(1, 1)):
+            local_visualizer.plt.plot([1, 2])
+    assert not local_visualizer.plt.get_fignums()